@@ -3,6 +3,8 @@ import os
 import re
 from typing import Literal
 
+_AUDIO_FILE_RE = re.compile(r"(\d+).*.mp3")
+
 
 @dataclass
 class BookMetadata:
@@ -17,6 +19,10 @@ class BookMetadata:
 class Book:
     def __init__(self, dir):
         self.dir = dir
+        if not os.path.exists(self.dir):
+            raise FileNotFoundError(f"Directory {self.dir} does not exist")
+        # List the directory once. All file lookups below are done against it.
+        self._entries = {entry.name: entry for entry in os.scandir(self.dir)}
         self._validate()
         self.cover_image = self._get_image("art")
         self.youtube_image = self._get_image("youtube")
@@ -28,13 +34,11 @@ class Book:
             )
 
     def _validate_file_exists(self, file):
-        if not os.path.exists(os.path.join(self.dir, file)):
+        if file not in self._entries:
             raise FileNotFoundError(f"File {file} does not exist in {self.dir}")
 
     def _validate(self):
         # Check that dir contains description.txt, ex-1.mp3, ex-2.mp3, art.png and youtube.png
-        if not os.path.exists(self.dir):
-            raise FileNotFoundError(f"Directory {self.dir} does not exist")
         self._validate_file_exists("description.txt")
         self._validate_file_exists("ex-1.mp3")
         self._validate_file_exists("ex-2.mp3")
@@ -46,35 +50,40 @@ class Book:
         return os.path.join(self.dir, "ex-2.mp3")
 
     def _get_audio_files(self) -> list[str]:
-        files = [file for file in os.listdir(self.dir) if re.match(r"\d+.*.mp3", file)]
-        files = sorted(files, key=lambda x: int(os.path.splitext(x)[0].split(" ")[0]))
-        return [os.path.join(self.dir, file) for file in files]
+        # Audio files start with chapter number: "01.mp3", "02 Title.mp3", etc.
+        numbered_files = []
+        for file in self._entries:
+            match = _AUDIO_FILE_RE.match(file)
+            if match:
+                numbered_files.append((int(match.group(1)), file))
+        numbered_files.sort()
+        return [os.path.join(self.dir, file) for _, file in numbered_files]
 
     def _parse_metadata(self) -> BookMetadata:
         data = {
-            "Апісанне": "",
             "Змест": [],
         }
+        description_lines = []
         with open(os.path.join(self.dir, "description.txt")) as f:
-            lines = f.readlines()
+            lines = f.read().splitlines()
 
             type: Literal["short_data", "description", "chapters"] = "short_data"
             for line in lines:
                 if type == "short_data":
                     if line.strip() == "":
                         type = "description"
-                    elif line.count(": ") == 0:
+                        continue
+                    key, separator, value = line.strip().partition(": ")
+                    if separator == "":
                         raise ValueError(
                             f"Invalid line in short data: {line}. Expected ':'."
                         )
-                    else:
-                        key, value = line.strip().split(": ")
-                        data[key] = value
+                    data[key] = value
                 elif type == "description":
                     if line.strip() == "Змест:":
                         type = "chapters"
                     else:
-                        data["Апісанне"] += line.strip() + "\n"
+                        description_lines.append(line.strip())
                 elif type == "chapters":
                     chapter = line.strip()
                     if chapter != "":
@@ -88,14 +97,14 @@ class Book:
             authors=maybe_split_empty(data.get("Аўтар", "")),
             narrators=maybe_split_empty(data.get("Чытае", "")),
             translators=maybe_split_empty(data.get("Пераклад", "")),
-            description=data["Апісанне"].strip(),
+            description="\n".join(description_lines).strip(),
             chapters=data["Змест"],
         )
 
     def _get_image(self, file) -> str:
         # Find image file with one of extendsions: .png, .jpg, .jpeg and return
         for ext in ["png", "jpg", "jpeg"]:
-            image = os.path.join(self.dir, file + "." + ext)
-            if os.path.exists(image):
-                return image
+            image = file + "." + ext
+            if image in self._entries:
+                return os.path.join(self.dir, image)
         raise FileNotFoundError(f"Image file for {file} not found")
@@ -0,0 +1,54 @@
+import os
+import shutil
+import sys
+from typing import Any
+
+from PIL import Image, ImageOps
+
+
+def fast_copy(src: str, dst: str):
+    """Copies file like shutil.copy but lets the kernel move the data with
+    sendfile() and read the source with sequential readahead. Used for
+    audio files that can be hundreds of megabytes."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    # Opening dst for writing would truncate src if both are the same file.
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        # sendfile() can write into regular files only on Linux.
+        if sys.platform != "linux" or not _sendfile(fsrc.fileno(), fdst.fileno()):
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copymode(src, dst)
+
+
+def resize_image(src: str, dst: str, box: tuple[int, int], **save_kwargs: Any):
+    """Same as ImageMagick's "-resize WxH": fits the image into the box keeping
+    aspect ratio, scaling up if needed."""
+    with Image.open(src) as image:
+        # Pillow resizes palette and bilevel images with nearest neighbour
+        # regardless of the requested filter, convert them to resample properly.
+        if image.mode in ("P", "1"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        ImageOps.contain(image, box, Image.Resampling.LANCZOS).save(dst, **save_kwargs)
+
+
+def _sendfile(fd_in: int, fd_out: int) -> bool:
+    """Copies the whole file with sendfile(). Returns False if the filesystem
+    doesn't support it (e.g. some FUSE or network mounts) and nothing was
+    copied, so the caller can fall back to a plain read/write copy."""
+    size = os.fstat(fd_in).st_size
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(fd_out, fd_in, offset, size - offset)
+        except OSError:
+            if offset == 0:
+                return False
+            raise
+        if sent == 0:
+            break
+        offset += sent
+    return True
@@ -1,15 +1,18 @@
 import datetime
 import logging
 import os
-import shutil
-import subprocess
+import tempfile
 
 
 import ffmpeg
 from book import Book
+from fileutil import fast_copy, resize_image
 from feedgen.feed import FeedGenerator
 from feedgen.ext.podcast import PodcastExtension
 import belorthography
+from probe_cache import get_bitrate, prefetch, probe
+
+PODTRAC_PREFIX = "http://www.podtrac.com/pts/redirect.mp3"
 
 
 def create_podcast(book_dir: str):
@@ -27,14 +30,11 @@ def create_podcast(book_dir: str):
     os.makedirs(podcast_dir, exist_ok=True)
 
     logging.info("Copying and resizing cover")
-    subprocess.run(
-        [
-            "convert",
-            book.cover_image,
-            "-resize",
-            "1400x1400",
-            os.path.join(podcast_dir, os.path.basename(book.cover_image)),
-        ],
+    resize_image(
+        book.cover_image,
+        os.path.join(podcast_dir, os.path.basename(book.cover_image)),
+        (1400, 1400),
+        quality=90,
     )
 
     logging.info("Copying mp3 files to podcast dir")
@@ -52,7 +52,7 @@ def create_podcast(book_dir: str):
                 [file, book.get_outro_file()], os.path.join(podcast_dir, basename)
             )
         else:
-            shutil.copy(file, podcast_dir)
+            fast_copy(file, podcast_dir)
 
     logging.info("Generating rss.xml")
     _generate_rss(book, podcast_dir)
@@ -93,25 +93,32 @@ def _generate_rss(book: Book, podcast_dir: str):
     podcast.itunes_explicit("no")
     podcast.itunes_complete("yes")
 
+    # Everything that doesn't depend on feedgen is computed upfront so that the
+    # loop below only fills in entries.
+    chapters = book.metadata.chapters
+    files = [
+        os.path.join(podcast_dir, os.path.basename(file)) for file in book.audio_files
+    ]
+    probes = _probe_all(files)
     first_pub_date = datetime.datetime.now(
         tz=datetime.timezone.utc
-    ) - datetime.timedelta(days=len(book.metadata.chapters))
-    for i, title in enumerate(book.metadata.chapters):
+    ) - datetime.timedelta(days=len(chapters))
+    pub_dates = [
+        first_pub_date + datetime.timedelta(days=i) for i in range(len(chapters))
+    ]
+    urls = [
+        f"{PODTRAC_PREFIX}/{full_gcs_path}/{os.path.basename(file)}" for file in files
+    ]
+    for i, title in enumerate(chapters):
+        # file size in bytes and duration
+        size, duration = probes[files[i]]
         entry = fg.add_entry()
         entry.guid(f"{gcs_folder_name}_{i}", permalink=True)
         entry.title(title)
-        podtrac_prefix = "http://www.podtrac.com/pts/redirect.mp3"
-        file = os.path.join(podcast_dir, os.path.basename(book.audio_files[i]))
-        entry.enclosure(
-            f"{podtrac_prefix}/{full_gcs_path}/{os.path.basename(file)}",
-            # get file size in bytes
-            os.path.getsize(file),
-            "audio/mpeg",
-        )
+        entry.enclosure(urls[i], size, "audio/mpeg")
         entry.podcast.itunes_episode(i + 1)
-        entry.podcast.itunes_duration(_get_duration(file))
-        entry.pubDate(first_pub_date)
-        first_pub_date += datetime.timedelta(days=1)
+        entry.podcast.itunes_duration(duration)
+        entry.pubDate(pub_dates[i])
     fg.rss_file(os.path.join(podcast_dir, "rss.xml"), pretty=True, encoding="utf-8")
     logging.info(f"GCS folder name is: {gcs_folder_name}")
     logging.info(
@@ -122,6 +129,9 @@ def _generate_rss(book: Book, podcast_dir: str):
 def _generate_gcs_folder_name(book: Book) -> str:
     name = " ".join(book.metadata.authors) + " " + book.metadata.title
     name = name.lower()
+    # Transliteration depends on neighbouring letters (iotated vowels, soft
+    # consonants) so it can't be replaced with a per-character str.translate
+    # table. It runs once per podcast so the cost doesn't matter.
     name = belorthography.convert(
         name,
         belorthography.Orthography.OFFICIAL,
@@ -131,20 +141,47 @@ def _generate_gcs_folder_name(book: Book) -> str:
     return name
 
 
-def _get_bitrate(file: str) -> int:
-    return int(ffmpeg.probe(file)["format"]["bit_rate"])
-
-
-def _get_duration(file: str) -> str:
-    result = ffmpeg.probe(file)
-    sec = float(result["format"]["duration"])
-    return str(datetime.timedelta(seconds=int(sec)))
+def _probe_all(files: list[str]) -> dict[str, tuple[int, str]]:
+    """Returns size in bytes and formatted duration for each file. Both come
+    from a single probe of the file."""
+    prefetch(files)
+    result = {}
+    for file in files:
+        info = probe(file)
+        result[file] = (
+            info.size,
+            str(datetime.timedelta(seconds=int(info.duration_sec))),
+        )
+    return result
 
 
 def _concat_files(files: list[str], output: str):
+    # Every MP3 frame carries its own bitrate, so stream copy needs only the
+    # same sample rate and number of channels.
+    formats = {(info.sample_rate, info.channels) for info in map(probe, files)}
+    if len(formats) == 1:
+        _concat_files_copy(files, output)
+        return
+    logging.info("Files have different formats, re-encoding them.")
     inputs = [ffmpeg.input(file) for file in files]
     ffmpeg.concat(*inputs, a=1, v=0).output(
         output,
-        audio_bitrate=_get_bitrate(files[0]),
+        audio_bitrate=get_bitrate(files[0]),
         ar=44100,
     ).run(overwrite_output=True, quiet=True)
+
+
+def _concat_files_copy(files: list[str], output: str):
+    """Concatenates files of the same format using concat demuxer. MP3 frames
+    are copied as is without decoding and re-encoding them."""
+    fd, list_file = tempfile.mkstemp(prefix="audiotools", suffix=".txt")
+    try:
+        with os.fdopen(fd, "w") as f:
+            for file in files:
+                escaped = os.path.abspath(file).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        ffmpeg.input(list_file, format="concat", safe=0).output(
+            output, acodec="copy", vn=None
+        ).run(overwrite_output=True, quiet=True)
+    finally:
+        os.remove(list_file)
@@ -0,0 +1,177 @@
+import atexit
+from collections.abc import Iterable, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import tempfile
+
+import mutagen
+from mutagen.mp3 import MP3, BitrateMode
+
+
+@dataclass(frozen=True)
+class AudioInfo:
+    duration_sec: float
+    bitrate: int
+    sample_rate: int
+    channels: int
+    size: int
+
+
+# Probe results keyed by (absolute path, mtime, size) so that a file
+# rewritten in place is probed again instead of returning stale data.
+# The cache is persisted between runs in _CACHE_FILE.
+_cache: MutableMapping[tuple[str, int, int], AudioInfo] = {}
+_cache_changed = False
+
+_CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "audiotools",
+    # Bumped when the meaning of cached values changes.
+    "probe-v2.json",
+)
+
+
+def _load_cache():
+    if not os.path.exists(_CACHE_FILE):
+        return
+    try:
+        with open(_CACHE_FILE) as f:
+            entries = json.load(f)
+        for path, entry in entries.items():
+            mtime_ns = entry.pop("mtime_ns")
+            info = AudioInfo(**entry)
+            _cache[(path, mtime_ns, info.size)] = info
+    except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+        logging.warning(f"Ignoring broken probe cache {_CACHE_FILE}: {e}")
+        _cache.clear()
+
+
+def _save_cache():
+    if not _cache_changed:
+        return
+    # Only the latest entry per file is kept. Entries are in insertion order
+    # so the most recent probe of a file overrides older ones. Entries of
+    # deleted files are dropped so the cache doesn't grow forever.
+    entries = {
+        path: {"mtime_ns": mtime_ns, **asdict(info)}
+        for (path, mtime_ns, _), info in _cache.items()
+        if os.path.exists(path)
+    }
+    cache_dir = os.path.dirname(_CACHE_FILE)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write into a temporary file and rename it so that concurrent runs
+        # never see a partially written cache.
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_file, _CACHE_FILE)
+    except OSError as e:
+        logging.warning(f"Failed to save probe cache {_CACHE_FILE}: {e}")
+
+
+_load_cache()
+atexit.register(_save_cache)
+
+
+def _cache_key(file: str) -> tuple[str, int, int]:
+    stat = os.stat(file)
+    return (os.path.abspath(file), stat.st_mtime_ns, stat.st_size)
+
+
+def _read_info(file: str) -> tuple[float, int, int, int]:
+    """Returns duration, bitrate, sample rate and number of channels of the file.
+    MP3 files are read in-process with mutagen from their frame/Xing headers,
+    which is much cheaper than starting ffprobe. Other formats, files mutagen
+    can't parse and its sketchy guesses fall back to ffprobe."""
+    if not file.lower().endswith(".mp3"):
+        return _ffprobe_info(file)
+    try:
+        info = MP3(file).info
+    except mutagen.MutagenError:
+        return _ffprobe_info(file)
+    # mutagen guesses frames in files that are not really MP3 and marks such
+    # results sketchy, their length and bitrate can't be trusted.
+    if info.sketchy:
+        return _ffprobe_info(file)
+    bitrate = info.bitrate
+    # mutagen derives CBR bitrate from the byte count, so short files come out
+    # slightly off (e.g. 127999). Round to the nominal bitrate callers compare
+    # against.
+    if info.bitrate_mode == BitrateMode.CBR:
+        bitrate = round(bitrate, -3)
+    return (info.length, bitrate, info.sample_rate, info.channels)
+
+
+def _ffprobe_info(file: str) -> tuple[float, int, int, int]:
+    # Ask only for the needed fields as plain key=value lines instead of
+    # dumping all streams and tags as JSON.
+    output = subprocess.check_output(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "format=duration,bit_rate:stream=sample_rate,channels",
+            "-of",
+            "default=noprint_wrappers=1",
+            file,
+        ]
+    ).decode("utf-8")
+    values = dict(line.split("=", 1) for line in output.splitlines())
+    return (
+        float(values["duration"]),
+        int(values["bit_rate"]),
+        int(values["sample_rate"]),
+        int(values["channels"]),
+    )
+
+
+def _probe_uncached(file: str, size: int) -> AudioInfo:
+    duration_sec, bitrate, sample_rate, channels = _read_info(file)
+    return AudioInfo(
+        duration_sec=duration_sec,
+        bitrate=bitrate,
+        sample_rate=sample_rate,
+        channels=channels,
+        size=size,
+    )
+
+
+def probe(file: str) -> AudioInfo:
+    """Returns metadata of the audio file. Each file is probed at most once,
+    across runs too, as long as it doesn't change on disk."""
+    global _cache_changed
+    key = _cache_key(file)
+    info = _cache.get(key)
+    if info is None:
+        info = _probe_uncached(file, size=key[2])
+        _cache[key] = info
+        _cache_changed = True
+    return info
+
+
+def prefetch(files: Iterable[str]):
+    """Probes all given files in parallel so that subsequent lookups are
+    served from the cache. Probing is mostly spent reading file headers or
+    waiting on ffprobe subprocesses so threads are enough here."""
+    missing = [file for file in files if _cache_key(file) not in _cache]
+    if len(missing) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as pool:
+        list(pool.map(probe, missing))
+
+
+def get_duration_sec(file: str) -> float:
+    return probe(file).duration_sec
+
+
+def get_bitrate(file: str) -> int:
+    return probe(file).bitrate
@@ -1,115 +1,128 @@
-from collections.abc import MutableSequence, MutableMapping
-import functools
+import asyncio
+from collections import deque
+from collections.abc import MutableMapping, MutableSequence, Sequence
 import logging
 import multiprocessing
 import os
 import re
-import subprocess
-import threading
-import time
 from typing import Any
 
-import ffmpeg
+from probe_cache import get_duration_sec
 
-
-@functools.cache
-def get_duration_sec(file: str) -> float:
-    result = ffmpeg.probe(file)
-    return float(result["format"]["duration"])
+_TIME_RE = re.compile(rb"time=(\d+):(\d+):(\d+)")
+# Lines printed by -progress look like "key=value".
+_PROGRESS_LINE_RE = re.compile(rb"^\w+=")
 
 
 class Scheduler:
     """Class that runs ffmpeg stream operations in parallel.
-    It runs N-1 thread where N is number of cores and keeps
-    track of progress in each thread."""
+    It runs up to N-1 ffmpeg processes where N is number of cores and keeps
+    track of progress of each of them. All processes are driven from a single
+    asyncio event loop."""
 
     def __init__(self):
-        self._waiting_jobs: MutableSequence[tuple[Any, str]] = []
-        self._running_threads: MutableSequence[threading.Thread] = []
-        self._lock = threading.Lock()
+        self._semaphore = asyncio.Semaphore(max(multiprocessing.cpu_count() - 1, 1))
+        self._waiting_jobs = 0
         self._current_progress: MutableMapping[str, int] = {}
+        self._finished: set[str] = set()
+        self._failed: MutableSequence[str] = []
+        self._progress_changed = asyncio.Event()
+        self._jobs: MutableSequence[asyncio.Task] = []
+        self._reporter: asyncio.Task | None = None
 
     def enqueue_job(self, stream: Any, file: str):
-        self._waiting_jobs.append((stream, file))
-        self._maybe_run_job()
+        """Schedules the job to run as soon as there is a free slot. Must be
+        called from a running event loop."""
+        self._waiting_jobs += 1
+        self._jobs.append(asyncio.create_task(self._run_job(stream, file)))
+        if self._reporter is None:
+            self._reporter = asyncio.create_task(self._report_progress())
 
-    def wait_till_all_finished(self):
-        while True:
-            self._clean_threads()
-            self._lock.acquire()
-            should_exit = (
-                len(self._waiting_jobs) == 0 and len(self._running_threads) == 0
-            )
-            self._lock.release()
-            if should_exit:
-                break
-            self._print_progress()
-            time.sleep(2)
+    async def wait_till_all_finished(self):
+        try:
+            await asyncio.gather(*self._jobs)
+        finally:
+            if self._reporter is not None:
+                self._reporter.cancel()
+                self._reporter = None
+        if self._failed:
+            raise RuntimeError(f"ffmpeg failed for {', '.join(self._failed)}")
         logging.info("All jobs are done")
 
-    def _clean_threads(self):
-        self._lock.acquire()
-        self._running_threads = [
-            thread for thread in self._running_threads if thread.is_alive()
-        ]
-        self._lock.release()
+    async def run(self, jobs: Sequence[tuple[Any, str]]):
+        """Runs all (stream, file) jobs and returns once all of them are done."""
+        for stream, file in jobs:
+            self.enqueue_job(stream, file)
+        await self.wait_till_all_finished()
 
-    def _maybe_run_job(self):
-        self._clean_threads()
-        self._lock.acquire()
-        max_threads = max(multiprocessing.cpu_count() - 1, 1)
-        if len(self._waiting_jobs) > 0 and len(self._running_threads) < max_threads:
-            stream, file = self._waiting_jobs.pop(0)
-            process = stream.run_async(overwrite_output=True, quiet=True)
-            new_thread = threading.Thread(
-                name=f"audiotools-{os.path.basename(file)}",
-                target=self._wait_till_finished,
-                args=(process, file),
+    async def _run_job(self, stream: Any, file: str):
+        async with self._semaphore:
+            self._waiting_jobs -= 1
+            # -progress makes ffmpeg print progress as separate lines instead
+            # of rewriting a single status line with \r.
+            args = stream.global_args("-nostats", "-progress", "pipe:2").compile(
+                overwrite_output=True
             )
-            new_thread.start()
-            self._running_threads.append(new_thread)
-        self._lock.release()
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            assert process.stderr
+            percent_per_sec = 100 / get_duration_sec(file)
+            short_name = os.path.basename(file)
+            self._current_progress[short_name] = 0
+            last_progress = 0
+            log_tail: deque[str] = deque(maxlen=20)
+            async for line in process.stderr:
+                # ffmpeg prints progess by printing time=hh:mm:ss text.
+                # We use it to understand how much is left related to the
+                # duration of the original file.
+                match = _TIME_RE.search(line)
+                if match is not None:
+                    hour, min, sec = map(int, match.groups())
+                    progress = int((hour * 3600 + min * 60 + sec) * percent_per_sec)
+                    if progress != last_progress:
+                        last_progress = progress
+                        self._current_progress[short_name] = progress
+                        self._progress_changed.set()
+                elif _PROGRESS_LINE_RE.match(line) is None:
+                    # Keep the tail of log output to report it if ffmpeg fails.
+                    log_tail.append(line.decode("utf8", errors="ignore").rstrip())
+            returncode = await process.wait()
+            self._current_progress[short_name] = 100
+            self._finished.add(short_name)
+            self._progress_changed.set()
+            if returncode != 0:
+                logging.error(
+                    f"ffmpeg failed for {short_name} with exit code {returncode}:\n"
+                    + "\n".join(log_tail)
+                )
+                # Remove truncated output, otherwise the next run would skip
+                # the file as already processed.
+                out_file = stream.node.kwargs["filename"]
+                if os.path.exists(out_file):
+                    os.remove(out_file)
+                self._failed.append(short_name)
 
-    def _wait_till_finished(self, process: subprocess.Popen, file: str):
-        assert process.stderr
-        assert process.stdout
-        buffer = ""
-        expected_duration = get_duration_sec(file)
-        short_name = os.path.basename(file)
+    async def _report_progress(self):
+        # Print progress only when it changes, but not more often than every 2s.
         while True:
-            out = process.stderr.read(10)
-            buffer += out.decode("utf8", errors="ignore")
-            # ffmpeg prints progess by printing time=hh:mm:ss text.
-            # We use it to understand how much is left related to the
-            # duration of the original file.
-            matches = re.findall("time=(\\d+):(\\d+):(\\d+)", buffer)
-            if len(matches) > 0:
-                buffer = ""
-                hour, min, sec = matches[0]
-                progress = int(
-                    100
-                    * (int(hour) * 3600 + int(min) * 60 + int(sec))
-                    / expected_duration
-                )
-                self._lock.acquire()
-                self._current_progress[short_name] = progress
-                self._lock.release()
-            if process.poll() == 0:
-                break
-        self._lock.acquire()
-        self._current_progress[short_name] = 100
-        self._lock.release()
-        self._maybe_run_job()
+            await self._progress_changed.wait()
+            self._progress_changed.clear()
+            self._print_progress()
+            await asyncio.sleep(2)
 
     def _print_progress(self):
-        self._lock.acquire()
         progress = self._current_progress
         progress_str = [f"{file}: {progress}%" for file, progress in progress.items()]
-        for file in list(progress.keys()):
-            if progress[file] == 100:
-                progress.pop(file)
+        # Drop only jobs whose ffmpeg exited: a running job can report 100%
+        # and still print more progress afterwards.
+        for file in self._finished:
+            progress.pop(file, None)
+        self._finished.clear()
         logging.info(
-            f"Progress. Enqueued {len(self._waiting_jobs)} jobs. Running: "
+            f"Progress. Enqueued {self._waiting_jobs} jobs. Running: "
             + "\t".join(progress_str)
         )
-        self._lock.release()
@@ -1,25 +1,31 @@
 import argparse
-from collections.abc import Sequence
-import functools
+import asyncio
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import multiprocessing
 import os
 import re
 from dataclasses import dataclass
 import tempfile
-import time
+import threading
 from typing import Any
 import readchar
-import shutil
 
 
 import ffmpeg
 import vlc
 
+from fileutil import fast_copy
 from podcast import create_podcast
+from probe_cache import AudioInfo, get_bitrate, get_duration_sec, prefetch, probe
 from scheduler import Scheduler
 from youtube import YoutubeVideoType, create_youtube
 
 DEFAULT_BITRATE = 224000
+BEEP_SEC = 0.5
+
+_SILENCE_RE = re.compile(rb"silence_end: ([\.\d]+) \| silence_duration: ([\.\d]+)")
 
 
 def str2bool(v):
@@ -48,139 +54,180 @@ class Silence:
 
 
 def create_tmp_audiofile() -> str:
-    return tempfile.mkstemp(prefix="audiotools", suffix=".mp3")[1]
-
-
-def get_silences(file: str) -> Sequence[Silence]:
+    # Previews are tiny and short-lived, keep them in memory-backed tmpfs
+    # when it's available.
+    dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, path = tempfile.mkstemp(prefix="audiotools", suffix=".mp3", dir=dir)
+    os.close(fd)
+    return path
+
+
+def get_silences(
+    file: str, start_sec: float = 0, length_sec: float | None = None
+) -> Iterator[Silence]:
+    """Yields silences in the file. start_sec and length_sec limit detection
+    to a part of the file, returned positions are relative to the start of the
+    file regardless. Silences are created lazily so callers interested only in
+    some of them don't pay for the rest."""
+    input_args: dict[str, float] = {}
+    if start_sec > 0:
+        input_args["ss"] = start_sec
+    if length_sec is not None:
+        input_args["t"] = length_sec
     command = (
-        ffmpeg.input(file)
+        ffmpeg.input(file, **input_args)
         .audio.filter("silencedetect", n="-50dB", d="0.5")
         .output("pipe:", format="null")
     )
     _, err = ffmpeg.run(command, capture_stderr=True)
-    result: Sequence[Silence] = []
-    for end, duration in re.findall(
-        "silence_end: ([\\.\\d]+) \\| silence_duration: ([\\.\\d]+)", err.decode("utf8")
-    ):
-        result.append(
-            Silence(
-                start_sec=float(end) - float(duration),
-                end_sec=float(end),
-                duration_sec=float(duration),
-            )
-        )
-    return result
-
-
-def generate_silence(duration_sec: float) -> ffmpeg.Stream:
-    # Generate silence into a separate file and return it as a stream.
-    # Originally we returned stream immediately without saving it into a file.
-    # It lead to noise being added to the main file. Don't know the root cause of the
-    # noise, but getting rid of "on-fly" streams fixes it.
-    silence_file = create_tmp_audiofile()
-    ffmpeg.input(f"anullsrc=duration={duration_sec}", f="lavfi").output(
-        silence_file, audio_bitrate=DEFAULT_BITRATE, ar=44100
-    ).run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
-    return ffmpeg.input(silence_file)
+    for match in _SILENCE_RE.finditer(err):
+        end = start_sec + float(match.group(1))
+        duration = float(match.group(2))
+        yield Silence(start_sec=end - duration, end_sec=end, duration_sec=duration)
+
+
+def get_edge_silences(
+    file: str, info: AudioInfo, head_sec: float, tail_sec: float
+) -> tuple[Silence | None, Silence | None]:
+    """Returns the first silence within first head_sec and the last silence
+    within last tail_sec of the file. Only silences at the edges matter for
+    padding so there is no need to decode the whole file."""
+    if info.duration_sec <= head_sec + tail_sec:
+        head = tail = get_silences(file)
+    else:
+        head = get_silences(file, length_sec=head_sec)
+        tail = get_silences(file, start_sec=info.duration_sec - tail_sec)
+    first = next(head, None)
+    # When the whole file is scanned at once the first silence can also be
+    # the last one.
+    last = first if head is tail else None
+    for last in tail:
+        pass
+    return (first, last)
+
+
+def add_silence(
+    stream: ffmpeg.Stream, begin_sec: float = 0, end_sec: float = 0
+) -> ffmpeg.Stream:
+    """Adds silence to the beginning and the end of the audio stream. Silence is
+    produced by adelay/apad filters on the stream itself so it's not needed to
+    generate and concatenate separate silence streams."""
+    if begin_sec > 0:
+        stream = stream.filter("adelay", delays=int(begin_sec * 1000), all=1)
+    if end_sec > 0:
+        stream = stream.filter("apad", pad_dur=end_sec)
+    return stream
 
 
 def last_few_sec_with_silence_and_beep(
-    file: str, silence_to_add_sec: float = 0, few_sec: float = 1
-) -> str:
-    beep = ffmpeg.input("sine=d=0.5:f=800", f="lavfi")
-    dur_sec = get_duration_sec(file) - (2 - silence_to_add_sec + few_sec)
+    file: str, info: AudioInfo, silence_to_add_sec: float = 0, few_sec: float = 1
+) -> tuple[str, float]:
+    """Returns preview file and its duration."""
+    beep = ffmpeg.input(f"sine=d={BEEP_SEC}:f=800", f="lavfi")
+    dur_sec = info.duration_sec - (2 - silence_to_add_sec + few_sec)
     res = create_tmp_audiofile()
-    ffmpeg.concat(
-        ffmpeg.input(file, ss=dur_sec),
-        generate_silence(silence_to_add_sec),
-        beep,
-        a=1,
-        v=0,
-    ).output(res, audio_bitrate=get_bitrate(file), ar=44100).run(
-        overwrite_output=True, capture_stdout=True, capture_stderr=True
-    )
-    return res
+    try:
+        ffmpeg.concat(
+            add_silence(
+                ffmpeg.input(file, ss=dur_sec).audio, end_sec=silence_to_add_sec
+            ),
+            beep,
+            a=1,
+            v=0,
+        ).output(res, audio_bitrate=info.bitrate, ar=44100).run(
+            overwrite_output=True, capture_stdout=True, capture_stderr=True
+        )
+    except BaseException:
+        os.remove(res)
+        raise
+    return (res, info.duration_sec - dur_sec + silence_to_add_sec + BEEP_SEC)
 
 
 def first_few_sec_with_silence_and_beep(
-    file: str, silence_to_add_sec: float = 0, few_sec: float = 1
-) -> str:
-    beep = ffmpeg.input("sine=d=0.5:f=800", f="lavfi")
+    file: str, info: AudioInfo, silence_to_add_sec: float = 0, few_sec: float = 1
+) -> tuple[str, float]:
+    """Returns preview file and its duration."""
+    beep = ffmpeg.input(f"sine=d={BEEP_SEC}:f=800", f="lavfi")
     dur_sec = few_sec + silence_to_add_sec
     res = create_tmp_audiofile()
-    ffmpeg.concat(
-        beep,
-        generate_silence(silence_to_add_sec),
-        ffmpeg.input(file, to=dur_sec),
-        a=1,
-        v=0,
-    ).output(res, audio_bitrate=get_bitrate(file), ar=44100).run(
-        overwrite_output=True, capture_stdout=True, capture_stderr=True
-    )
-    return res
+    try:
+        ffmpeg.concat(
+            beep,
+            add_silence(
+                ffmpeg.input(file, to=dur_sec).audio, begin_sec=silence_to_add_sec
+            ),
+            a=1,
+            v=0,
+        ).output(res, audio_bitrate=info.bitrate, ar=44100).run(
+            overwrite_output=True, capture_stdout=True, capture_stderr=True
+        )
+    except BaseException:
+        os.remove(res)
+        raise
+    return (res, BEEP_SEC + silence_to_add_sec + dur_sec)
 
 
 def pad_with_silence(
-    file: str, add_begin_sec: float, add_end_sec: float, dir: str
+    file: str, info: AudioInfo, add_begin_sec: float, add_end_sec: float, dir: str
 ) -> Any:
-    parts = []
-    if add_begin_sec > 0:
-        parts.append(generate_silence(add_begin_sec))
-    parts.append(ffmpeg.input(file))
-    if add_end_sec > 0:
-        parts.append(generate_silence(add_end_sec))
-    return ffmpeg.concat(*parts, a=1, v=0).output(
+    audio = add_silence(
+        ffmpeg.input(file).audio, begin_sec=add_begin_sec, end_sec=add_end_sec
+    )
+    return audio.output(
         os.path.join(dir, os.path.basename(file)),
-        audio_bitrate=get_bitrate(file),
+        audio_bitrate=info.bitrate,
         ar=44100,
     )
 
 
-def play_file(file: str):
+def play_file(file: str, duration_sec: float):
     player = vlc.MediaPlayer(file)
+    finished = threading.Event()
+    # Keep the event manager referenced while playing: it holds the callback
+    # that vlc calls, garbage collecting it would leave vlc a dangling pointer.
+    events = player.event_manager()
+    events.event_attach(vlc.EventType.MediaPlayerEndReached, lambda _: finished.set())
     player.play()
-    time.sleep(get_duration_sec(file))
-
-
-@functools.cache
-def get_duration_sec(file: str) -> float:
-    result = ffmpeg.probe(file)
-    return float(result["format"]["duration"])
+    # Timeout is a safety net in case vlc never reports the end of the file.
+    finished.wait(timeout=duration_sec + 1)
+    events.event_detach(vlc.EventType.MediaPlayerEndReached)
+    player.stop()
 
 
-@functools.cache
-def get_file_size(file: str) -> int:
-    return os.stat(file).st_size
+def play_preview(preview: tuple[str, float]):
+    """Plays (file, duration) preview and removes the file afterwards."""
+    file, duration_sec = preview
+    try:
+        play_file(file, duration_sec)
+    finally:
+        os.remove(file)
 
 
-def get_bitrate(file: str) -> int:
-    return int(ffmpeg.probe(file)["format"]["bit_rate"])
+def list_existing_files(dir: str) -> set[str]:
+    """Returns names of files in the dir with a single directory read."""
+    return set(os.listdir(dir)) if os.path.isdir(dir) else set()
 
 
 def how_much_silence_to_add_sec(
-    file: str, min_silence_begin_sec: float, min_silence_end_sec: float
+    info: AudioInfo,
+    edge_silences: tuple[Silence | None, Silence | None],
+    min_silence_begin_sec: float,
+    min_silence_end_sec: float,
 ) -> tuple[float, float]:
-    silences = get_silences(file)
-
-    if len(silences) == 0:
-        # there are no silences at all in the file
-        return (min_silence_begin_sec, min_silence_end_sec)
+    first_silence, last_silence = edge_silences
 
     to_add_begin = 0
-    first_silence = silences[0]
-    # the first silence is not at the very start of the file -
+    # there is no silence at the very start of the file -
     # fully pad file with silence.
-    if silences[0].start_sec > 0.1:
+    if first_silence is None or first_silence.start_sec > 0.1:
         to_add_begin = min_silence_begin_sec
     else:
         to_add_begin = max(0, min_silence_begin_sec - first_silence.duration_sec)
 
-    last_silence = silences[-1]
-    duration = get_duration_sec(file)
     to_add_end = 0
 
-    # the last silence is not at the end of the file
-    if duration - last_silence.end_sec > 0.2:
+    # there is no silence at the end of the file
+    if last_silence is None or info.duration_sec - last_silence.end_sec > 0.2:
         to_add_end = min_silence_end_sec
     else:
         to_add_end = max(0, min_silence_end_sec - last_silence.duration_sec)
@@ -189,27 +236,24 @@ def how_much_silence_to_add_sec(
 
 def maybe_pad_file_with_silence(
     file: str,
+    info: AudioInfo,
+    edge_silences: tuple[Silence | None, Silence | None],
     out_directory: str,
-    overwrite: bool,
     min_silence_begin_sec: float,
     min_silence_end_sec: float,
     play_paddings: bool,
 ) -> Any | None:
     """
-    Given a file add silence to the end if it doesn't have enough.
+    Given a file and its edge silences add silence to the end if it doesn't have enough.
     Returns ffmpeg stream or null if file doesnt need to be padded.
     """
     short_name = os.path.basename(file)
-    if not overwrite and os.path.exists(os.path.join(out_directory, short_name)):
-        logging.info(f"Skipping {short_name} as it already exists.")
-        return None
-
     to_add_begin, to_add_end = how_much_silence_to_add_sec(
-        file, min_silence_begin_sec, min_silence_end_sec
+        info, edge_silences, min_silence_begin_sec, min_silence_end_sec
     )
     if to_add_begin == 0 and to_add_end == 0:
         logging.info(f"To file {short_name} no need to add silence")
-        shutil.copy(file, out_directory)
+        fast_copy(file, out_directory)
         return None
     else:
         logging.info(
@@ -217,15 +261,17 @@ def maybe_pad_file_with_silence(
         )
 
     if play_paddings and to_add_begin > 0:
-        preview = first_few_sec_with_silence_and_beep(file, to_add_begin)
-        play_file(preview)
+        play_preview(first_few_sec_with_silence_and_beep(file, info, to_add_begin))
 
     if play_paddings and to_add_end > 0:
-        preview = last_few_sec_with_silence_and_beep(file, to_add_end)
-        play_file(preview)
+        play_preview(last_few_sec_with_silence_and_beep(file, info, to_add_end))
 
     return pad_with_silence(
-        file, add_begin_sec=to_add_begin, add_end_sec=to_add_end, dir=out_directory
+        file,
+        info,
+        add_begin_sec=to_add_begin,
+        add_end_sec=to_add_end,
+        dir=out_directory,
     )
 
 
@@ -239,20 +285,56 @@ def pad_silence_to_files(
 ):
     """Takes a list of files and adds silence to the end if there is not enough
     silence."""
-    audiofiles = sorted(files, key=get_file_size, reverse=True)
-    scheduler = Scheduler()
-    for file in audiofiles:
-        stream = maybe_pad_file_with_silence(
-            file,
-            out_directory=out_dir,
-            overwrite=overwrite,
-            min_silence_begin_sec=min_silence_begin_sec,
-            min_silence_end_sec=min_silence_end_sec,
-            play_paddings=play_paddings,
+    prefetch(files)
+    # Probe results are looked up once here and passed down to avoid
+    # stat-ing and looking up the same files over and over.
+    infos = {file: probe(file) for file in files}
+    existing = list_existing_files(out_dir)
+    audiofiles = []
+    for file in sorted(files, key=lambda f: infos[f].duration_sec, reverse=True):
+        short_name = os.path.basename(file)
+        if not overwrite and short_name in existing:
+            logging.info(f"Skipping {short_name} as it already exists.")
+            continue
+        audiofiles.append(file)
+
+    # Silence detection decodes the beginning and the end of each file so
+    # run it for all files in parallel before previews and encoding start.
+    # A few extra seconds are scanned to see how long edge silences are.
+    logging.info(f"Detecting silences in {len(audiofiles)} files")
+    max_workers = max(multiprocessing.cpu_count() - 1, 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        silences = pool.map(
+            lambda file: get_edge_silences(
+                file,
+                infos[file],
+                head_sec=min_silence_begin_sec + 5,
+                tail_sec=min_silence_end_sec + 5,
+            ),
+            audiofiles,
         )
-        if stream is not None:
-            scheduler.enqueue_job(stream, file)
-    scheduler.wait_till_all_finished()
+        all_silences = dict(zip(audiofiles, silences))
+
+    async def pad_files():
+        scheduler = Scheduler()
+        for file in audiofiles:
+            # Previews are rendered and played in a worker thread so that the
+            # event loop keeps encoding files enqueued earlier meanwhile.
+            stream = await asyncio.to_thread(
+                maybe_pad_file_with_silence,
+                file,
+                info=infos[file],
+                edge_silences=all_silences[file],
+                out_directory=out_dir,
+                min_silence_begin_sec=min_silence_begin_sec,
+                min_silence_end_sec=min_silence_end_sec,
+                play_paddings=play_paddings,
+            )
+            if stream is not None:
+                scheduler.enqueue_job(stream, file)
+        await scheduler.wait_till_all_finished()
+
+    asyncio.run(pad_files())
 
 
 def find_location_in_audiofile(file: str, start_location: float) -> float:
@@ -302,6 +384,7 @@ def cut_files(
     last_n_sec: float,
 ):
     """Cuts files removing first_n_sec and last_n_sec leaving the middle."""
+    prefetch(files)
     for file in files:
         short_name = os.path.basename(file)
         out_file = os.path.join(out_dir, short_name)
@@ -333,26 +416,28 @@ def cut_files(
 def ensure_quality(
     files: Sequence[str], out_dir: str, overwrite: bool, min_bitrate: int
 ):
-    audiofiles = sorted(files, key=get_file_size, reverse=True)
-    scheduler = Scheduler()
-    for file in audiofiles:
+    prefetch(files)
+    infos = {file: probe(file) for file in files}
+    existing = list_existing_files(out_dir)
+    jobs = []
+    for file in sorted(files, key=lambda f: infos[f].duration_sec, reverse=True):
         short_name = os.path.basename(file)
         out_file = os.path.join(out_dir, short_name)
-        if not overwrite and os.path.exists(out_file):
+        if not overwrite and short_name in existing:
             logging.info(f"Skipping {short_name} as it already exists.")
             continue
-        bitrate = get_bitrate(file)
+        bitrate = infos[file].bitrate
         if bitrate >= min_bitrate:
             logging.info(f"Skipping {short_name} as it has bitrate {bitrate}")
-            shutil.copy(file, out_dir)
+            fast_copy(file, out_dir)
             continue
 
         logging.info(f"Converting {short_name} because it has bitrate {bitrate}")
         stream = ffmpeg.input(file).output(
             out_file, audio_bitrate=min_bitrate, ar=44100
         )
-        scheduler.enqueue_job(stream, file)
-    scheduler.wait_till_all_finished()
+        jobs.append((stream, file))
+    asyncio.run(Scheduler().run(jobs))
 
 
 def parse_args() -> argparse.Namespace:
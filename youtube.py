@@ -1,4 +1,7 @@
+from collections.abc import Iterable
+import csv
 from enum import StrEnum
+import itertools
 import logging
 import os
 import re
@@ -6,6 +9,7 @@ import shutil
 import subprocess
 
 from book import Book
+from fileutil import resize_image
 
 
 class YoutubeVideoType(StrEnum):
@@ -59,14 +63,8 @@ def create_youtube(
             book.get_intro_file(), os.path.join(book_resource, "audio", "00.mp3")
         )
     os.remove(os.path.join(book_resource, "background.jpg"))
-    subprocess.run(
-        [
-            "convert",
-            book.youtube_image,
-            "-resize",
-            "1920x1080",
-            os.path.join(book_resource, "background.png"),
-        ],
+    resize_image(
+        book.youtube_image, os.path.join(book_resource, "background.png"), (1920, 1080)
     )
     shutil.copy(
         os.path.join(book.dir, "youtube_config.yml"),
@@ -146,19 +144,27 @@ def _generate_video_description(
 
 def _generate_chapters_csv(video_type: YoutubeVideoType, book: Book, out_dir: str):
     add_chapters = video_type == YoutubeVideoType.FREE
-    with open(os.path.join(out_dir, "chapters.csv"), "w") as f:
-        f.write("ID,Назва\n")
+    chapters: Iterable[str] = book.metadata.chapters
+    if video_type == YoutubeVideoType.PAID:
+        # For paid books we give provide only the first chapters on youtube.
+        chapters = itertools.islice(chapters, 3)
+    rows: list[tuple[int, str]] = []
+    for i, chapter in enumerate(chapters):
+        chapter_name = ""
+        if video_type == YoutubeVideoType.FREE:
+            chapter_name = chapter
+        elif video_type == YoutubeVideoType.MYSTERY_BOOK:
+            chapter_name = f"Частка {i + 1}"
+        rows.append((i + 1, chapter_name))
+    with open(os.path.join(out_dir, "chapters.csv"), "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["ID", "Назва"])
         if video_type != YoutubeVideoType.MYSTERY_BOOK:
             intro_name = "Уступ" if add_chapters else ""
-            f.write(f"0,{intro_name}\n")
-        for i, chapter in enumerate(book.metadata.chapters):
-            chapter_name = ""
-            if video_type == YoutubeVideoType.FREE:
-                chapter_name = chapter
-            elif video_type == YoutubeVideoType.MYSTERY_BOOK:
-                chapter_name = f"Частка {i + 1}"
-            f.write(f'{i+1},"{chapter_name}"\n')
-            # For paid books we give provide only the first chapter on youtube.
-            print(i)
-            if video_type == YoutubeVideoType.PAID and i > 1:
-                break
+            writer.writerow([0, intro_name])
+        # generate-chapters.ts expects chapter names always quoted, even
+        # empty ones.
+        chapter_writer = csv.writer(
+            f, lineterminator="\n", quoting=csv.QUOTE_NONNUMERIC
+        )
+        chapter_writer.writerows(rows)